@@ -1,20 +1,31 @@
+import time
+
+### Reference point for the startup budget check, taken before the heavy imports
+STARTUP_T0 = time.perf_counter()
+
+import asyncio
 import logging
 import os
 
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 from dotenv import load_dotenv
 from telegram import Update, Bot
+from telegram.error import BadRequest
 from telegram.ext import (
     filters,
     MessageHandler,
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
+    PollAnswerHandler,
 )
 
 import src.db_partite as db
 import src.API_connection as API
 
+### Time spent importing, measured before any network call
+IMPORT_TIME = time.perf_counter() - STARTUP_T0
+
 ### Load environment variables
 load_dotenv()
 
@@ -25,10 +36,38 @@ ALERT_EMOTE = "\U000026A0"
 WARNING_MARK = "\U000026A0"
 EXCLAMATION_MARK = "\U00002757"
 
+# Seconds allowed for the imports at launch
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", "0.5"))
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
 )
+logger = logging.getLogger(__name__)
+
+
+def check_startup_budget():
+    """
+    Check the import time against the startup budget
+    """
+    if IMPORT_TIME > STARTUP_BUDGET:
+        logger.warning(
+            "Imports took %.3fs, over the budget of %.3fs", IMPORT_TIME, STARTUP_BUDGET
+        )
+    else:
+        logger.info("Imports took %.3fs", IMPORT_TIME)
+
+
+async def warm_up(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Initialize the heavy subsystems in the background once polling has started
+    """
+    # the ready time also includes the network calls made by Application.initialize()
+    logger.info("Bot ready in %.3fs", time.perf_counter() - STARTUP_T0)
+
+    # create the database schema and load the rendering stack off the event loop
+    await asyncio.to_thread(db.init_db)
+    await asyncio.to_thread(API.warm_up)
 
 
 async def unknown_handler_func(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -65,7 +104,8 @@ async def get_image_group_stage(bot):
     """
     Get the image of the group stage
     """
-    group_stage_image = API.get_group_stage_standings()
+    # the API calls and the rendering are blocking, so they run off the event loop
+    group_stage_image = await asyncio.to_thread(API.get_group_stage_standings)
 
     # send the image to the group chat
     await bot.send_photo(
@@ -78,7 +118,8 @@ async def process_daily_matches(bot, job_queue):
     """
     Send the daily matches to the group chat in an automatic way
     """
-    matches_today, daily_image_calendar = API.get_daily_calendar()
+    # the API calls and the rendering are blocking, so they run off the event loop
+    matches_today, daily_image_calendar = await asyncio.to_thread(API.get_daily_calendar)
 
     if not matches_today:
         await bot.send_message(
@@ -88,36 +129,123 @@ async def process_daily_matches(bot, job_queue):
     else:
         if matches_today[0]["stage"] == "GROUP_STAGE":
             await get_image_group_stage(bot)
-        
-        await bot.send_photo(
-            chat_id=os.environ.get("GROUP_CHAT_ID"),
-            photo=daily_image_calendar,
+
+        # wait for the database initialization off the event loop, so the calls below
+        # never block on the lock held by warm_up
+        await asyncio.to_thread(db.init_db)
+        matches = db.sync_matches(matches_today)
+
+        # send the calendar and open the polls in a single round of concurrent requests
+        results = await asyncio.gather(
+            bot.send_photo(
+                chat_id=os.environ.get("GROUP_CHAT_ID"),
+                photo=daily_image_calendar,
+            ),
+            open_polls(bot, matches),
+            return_exceptions=True,
         )
-        await schedule_poll_closing(bot, job_queue, matches_today)
+        schedule_poll_closing(bot, job_queue, matches)
 
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
 
-def schedule_poll_closing(bot, job_queue, matches_today):
+
+async def open_polls(bot, matches):
     """
-    Schedule the closing of the polls
+    Send the prediction polls of the matches that don't have one yet and store them in one write
     """
-    current_time = datetime.now()
+    current_time = datetime.now(timezone.utc).replace(tzinfo=None)
+    existing_polls = db.get_polls([match.match_id for match in matches])
 
-    matches_today = [
+    new_matches = [
         match
-        for match in db.get_daily_matches(current_time.date())
-        if match.start_time > current_time
+        for match in matches
+        if match.match_id not in existing_polls and match.start_time > current_time
+    ]
+
+    if not new_matches:
+        return
+
+    # the option order matches db.OUTCOME_HOME, db.OUTCOME_DRAW and db.OUTCOME_AWAY
+    results = await asyncio.gather(
+        *[
+            bot.send_poll(
+                chat_id=os.environ.get("GROUP_CHAT_ID"),
+                question=f"[{match.match_id}] {match.team1} - {match.team2}",
+                options=[match.team1, "Draw", match.team2],
+                is_anonymous=False,
+            )
+            for match in new_matches
+        ],
+        return_exceptions=True,
+    )
+
+    # store every poll that was sent, even if some of the other sends failed
+    sent_polls = [
+        (result.poll.id, match.match_id, result.message_id)
+        for match, result in zip(new_matches, results)
+        if not isinstance(result, Exception)
     ]
+    skipped = db.add_polls(sent_polls)
+
+    # another run already stored a poll for these matches, remove the duplicates from the chat
+    if skipped:
+        logger.warning("Polls already stored for their match, deleting: %s", skipped)
+
+        duplicate_message_ids = [
+            message_id for poll_id, _, message_id in sent_polls if poll_id in skipped
+        ]
+        delete_results = await asyncio.gather(
+            *[
+                bot.delete_message(
+                    chat_id=os.environ.get("GROUP_CHAT_ID"), message_id=message_id
+                )
+                for message_id in duplicate_message_ids
+            ],
+            return_exceptions=True,
+        )
+        for message_id, result in zip(duplicate_message_ids, delete_results):
+            if isinstance(result, Exception):
+                logger.error("Could not delete the duplicate poll %s: %s", message_id, result)
+
+    failures = [
+        (match, result)
+        for match, result in zip(new_matches, results)
+        if isinstance(result, Exception)
+    ]
+    # the failed polls are sent again on the next run
+    for match, error in failures:
+        logger.error(
+            "Could not send the poll of %s - %s: %s", match.team1, match.team2, error
+        )
+
+
+def schedule_poll_closing(bot, job_queue, matches):
+    """
+    Schedule the closing of the polls at the start of the matches
+    """
+    current_time = datetime.now(timezone.utc).replace(tzinfo=None)
+    polls = db.get_polls([match.match_id for match in matches])
 
     def close_poll_func(match, poll):
-        return lambda: close_poll(bot, match, poll)
+        return lambda *args: close_poll(bot, match, poll)
+
+    for match in matches:
+        poll = polls.get(match.match_id)
 
-    for match in matches_today:
-        poll = db.get_poll(match.match_id)
+        if poll is None or poll.closed:
+            continue
+
+        # skip the polls whose closing is already scheduled
+        job_name = f"close_poll_{poll.poll_id}"
+        if job_queue.get_jobs_by_name(job_name):
+            continue
 
         job_queue.run_once(
-            close_poll_func(match, poll)(
-                match.start_time - current_time
-            ).total_seconds(),
+            close_poll_func(match, poll),
+            when=max((match.start_time - current_time).total_seconds(), 0),
+            name=job_name,
         )
 
 
@@ -125,17 +253,13 @@ async def close_poll(bot, match, poll):
     """
     Close the poll after the match has started
     """
-    message = await bot.stop_poll(
-        chat_id=os.environ.get("GROUP_CHAT_ID"), message_id=poll.poll_id
-    )
-
-    ### Add the bets to the database
-    for option_id, voters in enumerate(message.options):
-        for voter in voters.voter_ids:
-            if db.get_player(voter) is None:
-                db.add_player(user_id=voter, name=voters.voter_usernames[0], score=0)
-
-            db.add_bet(user_id=voter, poll_id=poll.poll_id, bet_value=option_id)
+    try:
+        await bot.stop_poll(
+            chat_id=os.environ.get("GROUP_CHAT_ID"), message_id=poll.message_id
+        )
+    except BadRequest as error:
+        # the poll was already closed or its message deleted, it can't receive votes anymore
+        logger.warning("Could not stop the poll %s, closing it: %s", poll.poll_id, error)
 
     db.close_poll(poll_id=poll.poll_id)
 
@@ -145,6 +269,32 @@ async def close_poll(bot, match, poll):
     )
 
 
+async def poll_answer_handler_func(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Save the bet of a player when they vote in a prediction poll
+    """
+    answer = update.poll_answer
+
+    # votes cast on behalf of a chat have no user
+    if answer.user is None:
+        return
+
+    # answers to polls that were not stored (like a deleted duplicate) don't count
+    if not db.poll_exists(answer.poll_id):
+        return
+
+    user_id = str(answer.user.id)
+
+    if db.get_player(user_id) is None:
+        db.add_player(user_id=user_id, name=answer.user.username or answer.user.first_name)
+
+    # an empty answer means the vote was retracted
+    if answer.option_ids:
+        db.add_bet(user_id=user_id, poll_id=answer.poll_id, bet_value=str(answer.option_ids[0]))
+    else:
+        db.delete_bet(user_id=user_id, poll_id=answer.poll_id)
+
+
 async def leaderboard_handler_func(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Send the leaderboard to the group chat
@@ -164,6 +314,73 @@ async def send_leaderboard_message(bot):
     await bot.send_message(chat_id=os.environ.get("GROUP_CHAT_ID"), text=message)
 
 
+async def mystats_handler_func(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Send the prediction stats of the player that issued the /mystats command
+    """
+    stats = db.get_player_stats(str(update.effective_user.id))
+
+    if stats is None or stats.bets == 0:
+        message = "You haven't made any prediction yet!"
+    else:
+        hit_rate = stats.hits / stats.settled * 100 if stats.settled else 0
+
+        message = f"""
+    {FIRE_EMOTE} STATS of {update.effective_user.first_name} {FIRE_EMOTE}
+
+    Predictions: {stats.bets} ({stats.settled} with a result)
+    Correct: {stats.hits} ({hit_rate:.0f}%)
+    Current streak: {stats.streak}
+    Best streak: {stats.best_streak}
+    Picks: home {stats.picks_home} - draw {stats.picks_draw} - away {stats.picks_away}
+    """
+
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
+async def groupstats_handler_func(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Send the group stats, or the votes of a match using /groupstats <match_id>
+    """
+    if context.args:
+        match_id = context.args[0]
+        poll_stats = db.get_poll_stats(match_id)
+
+        if poll_stats is None:
+            message = f"No closed poll for match {match_id}!"
+        else:
+            match = poll_stats.match
+            outcomes = [match.team1, "Draw", match.team2]
+            consensus = db.get_consensus(poll_stats)
+
+            message = f"""
+    {WARNING_MARK} {match.team1} - {match.team2} {WARNING_MARK}
+
+    {match.team1}: {poll_stats.votes_home}
+    Draw: {poll_stats.votes_draw}
+    {match.team2}: {poll_stats.votes_away}
+
+    Group pick: {outcomes[consensus] if consensus is not None else "-"}
+    Result: {outcomes[poll_stats.outcome] if poll_stats.outcome is not None else "Pending"}
+    """
+    else:
+        group_stats = db.get_group_stats()
+
+        if group_stats is None or group_stats.consensus_polls == 0:
+            message = "No match with a result and a clear group pick yet!"
+        else:
+            consensus_rate = group_stats.consensus_hits / group_stats.consensus_polls * 100
+
+            message = f"""
+    {WARNING_MARK} GROUP STATS {WARNING_MARK}
+
+    The group's pick was right {group_stats.consensus_hits} times out of {group_stats.consensus_polls} ({consensus_rate:.0f}%)
+    Matches without a clear group pick: {group_stats.settled_polls - group_stats.consensus_polls}
+    """
+
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
 async def update_result_handler_func(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ):
@@ -197,6 +414,8 @@ async def update_result_handler_func(
 
 
 def main():
+    check_startup_budget()
+
     ### Application
     application = ApplicationBuilder().token(os.environ.get("TELEGRAM_TOKEN")).build()
 
@@ -205,6 +424,9 @@ def main():
     sendtogroup_handler = CommandHandler("sendmessage", stg_handler_func)
     update_results_handler = CommandHandler("results", update_result_handler_func)
     leaderboard_handler = CommandHandler("leaderboard", leaderboard_handler_func)
+    mystats_handler = CommandHandler("mystats", mystats_handler_func)
+    groupstats_handler = CommandHandler("groupstats", groupstats_handler_func)
+    poll_answer_handler = PollAnswerHandler(poll_answer_handler_func)
 
     ### Unknown command handler
     unknown_handler = MessageHandler(filters.COMMAND, unknown_handler_func)
@@ -214,12 +436,18 @@ def main():
     application.add_handler(sendtogroup_handler)
     application.add_handler(update_results_handler)
     application.add_handler(leaderboard_handler)
+    application.add_handler(mystats_handler)
+    application.add_handler(groupstats_handler)
+    application.add_handler(poll_answer_handler)
 
     ### Unknown command handler
     application.add_handler(unknown_handler)
 
     bot, job_queue = application.bot, application.job_queue
 
+    ### Deferred initialization, runs as soon as polling starts
+    job_queue.run_once(warm_up, when=0)
+
     # schedule.every().minute.at(":00").do(process_daily)
 
     # schedule.every().day.at("07:00").do(process_daily)
@@ -1,31 +1,42 @@
-import requests
 import os
-import cairosvg
 import tempfile
-import pprint as pp
 from datetime import datetime
 
+### requests, cairosvg, PIL and src.image_generation are imported inside the functions
+### that need them, so importing this module at startup stays cheap. The environment
+### variables are loaded once by main.py.
 
-import src.image_generation as ig
 
-from PIL import Image
-from dotenv import load_dotenv
+def get_headers():
+    """
+    Get the headers of the football-data API, reading the key at call time
+    """
+    return {
+        "X-Auth-Token": os.getenv("API_KEY"),
+    }
 
-headers = {
-    "X-Auth-Token": os.getenv("API_KEY"),
-}
 
-### Load the environment variables that is located in the .env file one directory above
-load_dotenv(dotenv_path="../.env")
+def warm_up():
+    """
+    Import the heavy rendering dependencies ahead of the first image request
+    """
+    import requests
+    import cairosvg
+    import PIL.Image
+    import src.image_generation
 
 
 def get_team_flag(team_name):
     """
     Get the flag of the team in PNG format
     """
+    import requests
+    import cairosvg
+    from PIL import Image
+
     # get the teams
     teams_url = "https://api.football-data.org/v4/competitions/EC/teams"
-    teams_response = requests.get(teams_url, headers=headers)
+    teams_response = requests.get(teams_url, headers=get_headers())
     teams = teams_response.json()
 
     # create the path of the flag
@@ -67,9 +78,12 @@ def get_group_stage_standings():
     """
     Get the group stage and the corresponding teams in order to generate the image of the groups
     """
+    import requests
+    import src.image_generation as ig
+
     # get the euro 2024 group stages
     teams_url = "https://api.football-data.org/v4/competitions/EC/standings"
-    teams_response = requests.get(teams_url, headers=headers)
+    teams_response = requests.get(teams_url, headers=get_headers())
     teams = teams_response.json()
 
     # return the image of the group stage
@@ -80,6 +94,8 @@ def get_daily_calendar():
     """
     Get the daily calendar of matches
     """
+    import requests
+    import src.image_generation as ig
 
     # create a function to obtain only the matches of the current day
     def get_matches_today(matches):
@@ -99,7 +115,7 @@ def get_daily_calendar():
 
     # get the euro 2024 calendar
     calendar_url = "https://api.football-data.org/v4/competitions/EC/matches"
-    calendar_response = requests.get(calendar_url, headers=headers)
+    calendar_response = requests.get(calendar_url, headers=get_headers())
     calendar = calendar_response.json()
 
     # get the matches
@@ -1,9 +1,20 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey
+import re
+import logging
+import threading
+
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, DateTime, Boolean, ForeignKey, Index
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
-engine = create_engine("sqlite:///resources/euro2024.db")
+Session = sessionmaker()
+
+DATABASE_URL = "sqlite:///resources/euro2024.db"
 
 ### DATABASE ###
 
@@ -21,8 +32,10 @@ class Polls(Base):
     __tablename__ = "polls"
     poll_id = Column(String, primary_key=True)
     match_id = Column(Integer, ForeignKey("matches.match_id"))
+    message_id = Column(Integer)
     closed = Column(Boolean)
     match = relationship("Matches")
+    __table_args__ = (Index("ix_polls_match_id", "match_id", unique=True),)
 
 
 class Players(Base):
@@ -40,17 +53,107 @@ class Bets(Base):
     player = relationship("Players")
     poll = relationship("Polls")
 
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+
+### AGGREGATES ###
+
+# poll options, in the order they are shown in the prediction poll
+OUTCOME_HOME = 0
+OUTCOME_DRAW = 1
+OUTCOME_AWAY = 2
+
+
+class PlayerStats(Base):
+    __tablename__ = "player_stats"
+    player_id = Column(String, ForeignKey("players.player_id"), primary_key=True)
+    bets = Column(Integer, default=0)
+    settled = Column(Integer, default=0)
+    hits = Column(Integer, default=0)
+    streak = Column(Integer, default=0)
+    best_streak = Column(Integer, default=0)
+    picks_home = Column(Integer, default=0)
+    picks_draw = Column(Integer, default=0)
+    picks_away = Column(Integer, default=0)
+    last_kickoff = Column(DateTime)
+    player = relationship("Players")
+
+
+class PollStats(Base):
+    __tablename__ = "poll_stats"
+    poll_id = Column(String, ForeignKey("polls.poll_id"), primary_key=True)
+    match_id = Column(Integer, ForeignKey("matches.match_id"))
+    votes_home = Column(Integer, default=0)
+    votes_draw = Column(Integer, default=0)
+    votes_away = Column(Integer, default=0)
+    outcome = Column(Integer)
+    match = relationship("Matches")
+
+
+class GroupStats(Base):
+    __tablename__ = "group_stats"
+    id = Column(Integer, primary_key=True)
+    settled_polls = Column(Integer, default=0)
+    consensus_polls = Column(Integer, default=0)
+    consensus_hits = Column(Integer, default=0)
+
+
+### LAZY INITIALIZATION ###
+
+_session = None
+_session_lock = threading.Lock()
+
+
+# get the shared session, creating the engine and the tables on first use
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                engine = create_engine(DATABASE_URL)
+                Base.metadata.create_all(engine)
+                _migrate(engine)
+                Session.configure(bind=engine)
+                _session = Session()
+    return _session
+
+
+# bring the tables created by older versions up to date, create_all doesn't alter existing tables
+def _migrate(engine):
+    poll_columns = [column["name"] for column in inspect(engine).get_columns("polls")]
+    player_stats_columns = [column["name"] for column in inspect(engine).get_columns("player_stats")]
+    group_stats_columns = [column["name"] for column in inspect(engine).get_columns("group_stats")]
+
+    with engine.begin() as connection:
+        # a missing last_kickoff makes the next settle rescan the streaks of the player
+        if "last_kickoff" not in player_stats_columns:
+            connection.execute(text("ALTER TABLE player_stats ADD COLUMN last_kickoff DATETIME"))
+        # ties were counted as a consensus before
+        if "consensus_polls" not in group_stats_columns:
+            connection.execute(text("ALTER TABLE group_stats ADD COLUMN consensus_polls INTEGER DEFAULT 0"))
+            connection.execute(text("UPDATE group_stats SET consensus_polls = settled_polls"))
+        if "message_id" not in poll_columns:
+            connection.execute(text("ALTER TABLE polls ADD COLUMN message_id INTEGER"))
+
+    # the index can't be created while a match has several polls, the bot keeps working without it
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                text("CREATE UNIQUE INDEX IF NOT EXISTS ix_polls_match_id ON polls (match_id)")
+            )
+    except IntegrityError as error:
+        logger.error("Could not create the unique index on polls.match_id: %s", error)
+
+
+# initialize the database ahead of the first query (safe to call from a background thread)
+def init_db():
+    get_session()
+
 
 ### FUNCTIONS ###
 
 
-# add a new match
-def add_match(team1, team2, start_time):
-    # calculate the next match_id
-    match_id = session.query(Matches).count() + 1
+# add a new match, match_id is the football-data id of the match
+def add_match(match_id, team1, team2, start_time):
+    session = get_session()
     match = Matches(
         match_id=match_id,
         team1=team1,
@@ -63,15 +166,87 @@ def add_match(team1, team2, start_time):
     return match.match_id
 
 
+# add the matches coming from the API that are not in the database yet, using the API id as match_id
+def sync_matches(api_matches):
+    session = get_session()
+    match_ids = [api_match["id"] for api_match in api_matches]
+    matches = {
+        match.match_id: match
+        for match in session.query(Matches).filter(Matches.match_id.in_(match_ids))
+    }
+
+    for api_match in api_matches:
+        if api_match["id"] not in matches:
+            match = Matches(
+                match_id=api_match["id"],
+                team1=api_match["homeTeam"]["name"],
+                team2=api_match["awayTeam"]["name"],
+                start_time=datetime.strptime(api_match["utcDate"], "%Y-%m-%dT%H:%M:%S%z").replace(tzinfo=None),
+                result="Pending",
+            )
+            session.add(match)
+            matches[match.match_id] = match
+
+    session.commit()
+    return [matches[match_id] for match_id in match_ids]
+
+
 # add a new poll
-def add_poll(poll_id, match_id):
-    poll = Polls(poll_id=poll_id, match_id=match_id, closed=False)
+def add_poll(poll_id, match_id, message_id=None):
+    session = get_session()
+    poll = Polls(poll_id=poll_id, match_id=match_id, message_id=message_id, closed=False)
     session.add(poll)
     session.commit()
 
 
+# add several polls in a single commit, polls is a list of (poll_id, match_id, message_id).
+# Polls of matches that already have one are skipped, their poll_ids are returned
+def add_polls(polls):
+    session = get_session()
+    existing_match_ids = {
+        match_id
+        for (match_id,) in session.query(Polls.match_id).filter(
+            Polls.match_id.in_([match_id for _, match_id, _ in polls])
+        )
+    }
+
+    new_polls, skipped = [], []
+    for poll_id, match_id, message_id in polls:
+        if match_id in existing_match_ids:
+            skipped.append(poll_id)
+        else:
+            existing_match_ids.add(match_id)
+            new_polls.append(
+                Polls(poll_id=poll_id, match_id=match_id, message_id=message_id, closed=False)
+            )
+
+    try:
+        session.add_all(new_polls)
+        session.commit()
+    except IntegrityError:
+        # another run stored some of the polls in the meantime, add them one by one
+        session.rollback()
+        for poll in new_polls:
+            try:
+                session.add(
+                    Polls(
+                        poll_id=poll.poll_id,
+                        match_id=poll.match_id,
+                        message_id=poll.message_id,
+                        closed=False,
+                    )
+                )
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                skipped.append(poll.poll_id)
+
+    return skipped
+
+
 # add a new player
 def add_player(user_id, name):
+    session = get_session()
     player = Players(player_id=user_id, name=name, score=0)
     session.add(player)
     session.commit()
@@ -79,6 +254,7 @@ def add_player(user_id, name):
 
 # add points to a player. Check if the player exists update the score, otherwise create a new player
 def add_points(user_id, points):
+    session = get_session()
     player = session.query(Players).filter(Players.player_id == user_id).first()
     if player is None:
         add_player(user_id, "")
@@ -87,65 +263,317 @@ def add_points(user_id, points):
         session.commit()
 
 
-# add a new bet
+# add a new bet, replacing the previous bet of the player on the same poll
 def add_bet(user_id, poll_id, bet_value):
+    session = get_session()
     bet = Bets(user_id=user_id, poll_id=poll_id, bet_value=bet_value)
-    session.add(bet)
+    session.merge(bet)
+    session.commit()
+
+
+# delete the bet of a player on a poll (the vote was retracted)
+def delete_bet(user_id, poll_id):
+    session = get_session()
+    session.query(Bets).filter(Bets.user_id == user_id, Bets.poll_id == poll_id).delete()
     session.commit()
 
 
 # get the match from match_id
 def get_match(match_id):
+    session = get_session()
     match = session.query(Matches).filter(Matches.match_id == match_id).first()
     return match
 
 
 # get the poll_id from match_id
 def get_poll_id(match_id):
+    session = get_session()
     poll = session.query(Polls).filter(Polls.match_id == match_id).first()
     return poll.poll_id
 
 
+# get the poll from match_id
+def get_poll(match_id):
+    session = get_session()
+    poll = session.query(Polls).filter(Polls.match_id == match_id).first()
+    return poll
+
+
+# check if a poll is stored
+def poll_exists(poll_id):
+    session = get_session()
+    return session.get(Polls, poll_id) is not None
+
+
+# get the polls of several matches as a dictionary match_id -> poll
+def get_polls(match_ids):
+    session = get_session()
+    polls = session.query(Polls).filter(Polls.match_id.in_(match_ids)).all()
+    return {poll.match_id: poll for poll in polls}
+
+
 # get all the daily matches
 def get_daily_matches(start_date):
+    session = get_session()
     matches = session.query(Matches).filter(Matches.start_time.like(f"{start_date}%")).all()
     return matches
 
 
 # close a poll
 def close_poll(poll_id):
+    session = get_session()
     poll = session.query(Polls).filter(Polls.poll_id == poll_id).first()
     poll.closed = True
+    _record_poll_stats(session, poll)
+
+    # the result may have been saved before the poll was closed
+    poll_stats = session.get(PollStats, poll.poll_id)
+    _settle_poll_stats(session, poll_stats, get_outcome(poll.match.result))
     session.commit()
 
 
 # update the result of a match
 def update_result(match_id, result):
+    session = get_session()
     match = session.query(Matches).filter(Matches.match_id == match_id).first()
     match.result = result
+
+    # a corrected outcome can't be applied incrementally, so the aggregates are rebuilt
+    poll_stats = session.query(PollStats).filter(PollStats.match_id == match_id).first()
+    if poll_stats is not None and poll_stats.outcome is not None:
+        session.commit()
+        if get_outcome(result) != poll_stats.outcome:
+            rebuild_stats()
+        return
+
+    if poll_stats is not None:
+        _settle_poll_stats(session, poll_stats, get_outcome(result))
     session.commit()
 
 
 # get the bets of a poll
 def get_bets(poll_id):
+    session = get_session()
     bets = session.query(Bets).filter(Bets.poll_id == poll_id).all()
     return bets
 
 
 # get player
 def get_player(user_id):
+    session = get_session()
     player = session.query(Players).filter(Players.player_id == user_id).first()
     return player
 
 
 # get the leaderboard
 def get_leaderboard():
+    session = get_session()
     leaderboard = session.query(Players).order_by(Players.score.desc()).all()
     return leaderboard
 
 
 # delete a match
 def delete_match(match_id):
+    session = get_session()
     match = session.query(Matches).filter(Matches.match_id == match_id).first()
     session.delete(match)
-    session.commit()
\ No newline at end of file
+    session.commit()
+
+
+### STATISTICS ###
+
+
+# get the outcome (OUTCOME_HOME, OUTCOME_DRAW or OUTCOME_AWAY) of a result like "2-1", None if it can't be parsed
+def get_outcome(result):
+    score = re.match(r"\s*(\d+)\s*[-:]\s*(\d+)\s*$", result or "")
+    if score is None:
+        return None
+
+    home, away = int(score.group(1)), int(score.group(2))
+    if home > away:
+        return OUTCOME_HOME
+    if home < away:
+        return OUTCOME_AWAY
+    return OUTCOME_DRAW
+
+
+# get the option picked by most of the group, None if nobody voted or the top count is shared
+def get_consensus(poll_stats):
+    votes = [poll_stats.votes_home, poll_stats.votes_draw, poll_stats.votes_away]
+    top_votes = max(votes)
+    if top_votes == 0 or votes.count(top_votes) > 1:
+        return None
+    return votes.index(top_votes)
+
+
+# get the stats row of a player, creating it if needed
+def _get_or_create_player_stats(session, user_id):
+    stats = session.get(PlayerStats, user_id)
+    if stats is None:
+        stats = PlayerStats(
+            player_id=user_id,
+            bets=0,
+            settled=0,
+            hits=0,
+            streak=0,
+            best_streak=0,
+            last_kickoff=None,
+            picks_home=0,
+            picks_draw=0,
+            picks_away=0,
+        )
+        session.add(stats)
+    return stats
+
+
+# get the single row of the group stats, creating it if needed
+def _get_or_create_group_stats(session):
+    stats = session.get(GroupStats, 1)
+    if stats is None:
+        stats = GroupStats(id=1, settled_polls=0, consensus_polls=0, consensus_hits=0)
+        session.add(stats)
+    return stats
+
+
+# count the votes of a closed poll and the picks of its voters (without committing)
+def _record_poll_stats(session, poll):
+    if session.get(PollStats, poll.poll_id) is not None:
+        return
+
+    poll_stats = PollStats(
+        poll_id=poll.poll_id,
+        match_id=poll.match_id,
+        votes_home=0,
+        votes_draw=0,
+        votes_away=0,
+    )
+    session.add(poll_stats)
+
+    for bet in session.query(Bets).filter(Bets.poll_id == poll.poll_id).all():
+        stats = _get_or_create_player_stats(session, bet.user_id)
+        stats.bets += 1
+
+        option = int(bet.bet_value)
+        if option == OUTCOME_HOME:
+            poll_stats.votes_home += 1
+            stats.picks_home += 1
+        elif option == OUTCOME_DRAW:
+            poll_stats.votes_draw += 1
+            stats.picks_draw += 1
+        elif option == OUTCOME_AWAY:
+            poll_stats.votes_away += 1
+            stats.picks_away += 1
+
+
+# apply the outcome of a match to the stats of its poll and voters (without committing)
+def _settle_poll_stats(session, poll_stats, outcome):
+    if outcome is None or poll_stats.outcome is not None:
+        return
+
+    poll_stats.outcome = outcome
+
+    group_stats = _get_or_create_group_stats(session)
+    group_stats.settled_polls += 1
+
+    # polls without a clear group pick are left out of the consensus rate
+    consensus = get_consensus(poll_stats)
+    if consensus is not None:
+        group_stats.consensus_polls += 1
+        if consensus == outcome:
+            group_stats.consensus_hits += 1
+
+    kickoff = poll_stats.match.start_time
+
+    for bet in session.query(Bets).filter(Bets.poll_id == poll_stats.poll_id).all():
+        stats = _get_or_create_player_stats(session, bet.user_id)
+        hit = int(bet.bet_value) == outcome
+
+        stats.settled += 1
+        if hit:
+            stats.hits += 1
+
+        # streaks follow the kickoff order: a result entered out of order needs a rescan,
+        # otherwise (always the case in rebuild_stats) the streak is carried forward
+        if (stats.last_kickoff is None and stats.settled > 1) or (
+            stats.last_kickoff is not None and kickoff < stats.last_kickoff
+        ):
+            _rescan_streaks(session, stats)
+        else:
+            stats.streak = stats.streak + 1 if hit else 0
+            stats.best_streak = max(stats.best_streak, stats.streak)
+            stats.last_kickoff = kickoff
+
+
+# recompute the streaks of a player over the settled polls in kickoff order (without committing)
+def _rescan_streaks(session, stats):
+    settled_bets = (
+        session.query(Bets.bet_value, PollStats.outcome, Matches.start_time)
+        .join(PollStats, PollStats.poll_id == Bets.poll_id)
+        .join(Matches, Matches.match_id == PollStats.match_id)
+        .filter(Bets.user_id == stats.player_id, PollStats.outcome.isnot(None))
+        .order_by(Matches.start_time)
+        .all()
+    )
+
+    stats.streak = 0
+    stats.best_streak = 0
+    for bet_value, outcome, kickoff in settled_bets:
+        stats.last_kickoff = kickoff
+        if int(bet_value) == outcome:
+            stats.streak += 1
+            stats.best_streak = max(stats.best_streak, stats.streak)
+        else:
+            stats.streak = 0
+
+
+# rebuild all the aggregates from the bets history, in match order
+def rebuild_stats():
+    session = get_session()
+    session.query(PlayerStats).delete()
+    session.query(PollStats).delete()
+    session.query(GroupStats).delete()
+    session.flush()
+
+    closed_polls = (
+        session.query(Polls)
+        .join(Matches)
+        .filter(Polls.closed.is_(True))
+        .order_by(Matches.start_time)
+        .all()
+    )
+
+    for poll in closed_polls:
+        _record_poll_stats(session, poll)
+        session.flush()
+
+        poll_stats = session.get(PollStats, poll.poll_id)
+        _settle_poll_stats(session, poll_stats, get_outcome(poll.match.result))
+        session.flush()
+
+    session.commit()
+
+
+# get the stats of a player
+def get_player_stats(user_id):
+    session = get_session()
+    return session.get(PlayerStats, user_id)
+
+
+# get the stats of the poll of a match
+def get_poll_stats(match_id):
+    session = get_session()
+    poll_stats = session.query(PollStats).filter(PollStats.match_id == match_id).first()
+    return poll_stats
+
+
+# get the stats of the group
+def get_group_stats():
+    session = get_session()
+    return session.get(GroupStats, 1)
+
+
+### OFFLINE JOBS ###
+
+# rebuild the aggregates from the history with: python -m src.db_partite
+if __name__ == "__main__":
+    rebuild_stats()
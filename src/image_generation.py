@@ -1,15 +1,138 @@
 import os
 import io
+import time
+import logging
+import threading
 
 import src.API_connection as API
 
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
 from PIL import Image, ImageDraw, ImageFont, ImageEnhance
 
+logger = logging.getLogger(__name__)
 
-## Load the environment variables that is located in the .env file one directory above
-load_dotenv(dotenv_path="../.env")
+# file extension used as the upload name for each output format
+IMAGE_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+# scratch buffer of each rendering thread, reused across renders for the encode attempts
+_buffers = threading.local()
+
+
+def get_scratch_buffer():
+    """
+    Get the empty scratch buffer of the current thread
+    """
+    buffer = getattr(_buffers, "scratch", None)
+    if buffer is None:
+        buffer = _buffers.scratch = io.BytesIO()
+
+    buffer.seek(0)
+    buffer.truncate()
+    return buffer
+
+
+def encode_attempt(image, image_format, quality, buffer):
+    """
+    Encode the image into the buffer and return the size in bytes.
+    PNG is saved as an optimized 256 color palette image and ignores the quality
+    """
+    buffer.seek(0)
+    buffer.truncate()
+
+    if image_format == "PNG":
+        image.quantize(colors=256).save(buffer, format="PNG", optimize=True)
+    else:
+        image.save(buffer, format=image_format, quality=quality, optimize=True)
+
+    return buffer.tell()
+
+
+def encode_png_baseline(image):
+    """
+    Encode the canvas as the default PNG the renderers used to upload and return the size in bytes
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.tell()
+
+
+def encode_image(image):
+    """
+    Encode the image for the Telegram upload.
+    The formats listed in IMAGE_FORMATS (JPEG, WEBP, PNG) are tried in order, lowering the quality
+    from IMAGE_QUALITY to IMAGE_MIN_QUALITY, and the first one that fits IMAGE_MAX_BYTES is used.
+    If none fits, the smallest attempt is used.
+    The attempts reuse the scratch buffer of the thread, the result is returned in a new buffer
+    owned by the caller
+    """
+    image_formats = [
+        image_format.strip().upper()
+        for image_format in os.environ.get("IMAGE_FORMATS", "JPEG,WEBP,PNG").split(",")
+    ]
+    quality = int(os.environ.get("IMAGE_QUALITY", "85"))
+    min_quality = int(os.environ.get("IMAGE_MIN_QUALITY", "50"))
+    max_bytes = int(os.environ.get("IMAGE_MAX_BYTES", "200000"))
+
+    for image_format in image_formats:
+        if image_format not in IMAGE_EXTENSIONS:
+            raise ValueError(f"Unsupported image format: {image_format}")
+
+    start_time = time.perf_counter()
+
+    # the canvas is fully opaque, so the alpha channel can be dropped
+    rgb_image = image.convert("RGB")
+
+    buffer = get_scratch_buffer()
+    qualities = list(range(quality, min_quality, -10)) + [min_quality]
+
+    # smallest attempt as (size, format, quality)
+    best = None
+    fits = False
+
+    for image_format in image_formats:
+        for attempt_quality in [None] if image_format == "PNG" else qualities:
+            size = encode_attempt(rgb_image, image_format, attempt_quality, buffer)
+
+            if best is None or size < best[0]:
+                best = (size, image_format, attempt_quality)
+
+            if size <= max_bytes:
+                fits = True
+                break
+
+        if fits:
+            break
+
+    if not fits:
+        size, image_format, attempt_quality = best
+        encode_attempt(rgb_image, image_format, attempt_quality, buffer)
+
+    encode_time = time.perf_counter() - start_time
+
+    # copy the result out, so the scratch buffer can be reused by the next render
+    image_bytes = io.BytesIO(buffer.getvalue())
+
+    logger.info(
+        "Encoded %s image (quality %s) in %.1fms: %d bytes, %d bytes saved over the raw canvas%s",
+        image_format,
+        attempt_quality if attempt_quality is not None else "-",
+        encode_time * 1000,
+        size,
+        image.width * image.height * 4 - size,
+        "" if fits else f" (over the budget of {max_bytes} bytes)",
+    )
+
+    # the PNG the renderers used to upload costs far more than the encode itself, so it's only
+    # measured when debugging
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "%d bytes saved over the PNG canvas", encode_png_baseline(image) - size
+        )
+
+    # the name lets Telegram detect the file type of the upload
+    image_bytes.name = f"image.{IMAGE_EXTENSIONS[image_format]}"
+
+    return image_bytes
 
 
 def image_settings(image):
@@ -86,12 +209,8 @@ def get_image_group_stage(teams):
             y = height // 2 - 300
             x += 300
 
-    # save the image using BytesIO
-    image_bytes = io.BytesIO()
-    image.save(image_bytes, format="PNG")
-    image_bytes.seek(0)
-
-    return image_bytes
+    # encode the image for the upload
+    return encode_image(image)
 
 
 def get_matchday_image(today_matches):
@@ -185,9 +304,5 @@ def get_matchday_image(today_matches):
         draw.text((x + 300, y), f"{score_away}", fill=text_color, font=font_match)
         y += 100
 
-    # save the image using BytesIO
-    image_bytes = io.BytesIO()
-    image.save(image_bytes, format="PNG")
-    image_bytes.seek(0)
-
-    return image_bytes
+    # encode the image for the upload
+    return encode_image(image)